@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import io
+import os
 import sys
 import gzip
-import faiss
+os.environ.setdefault('OMP_PROC_BIND', 'close') ### keep OMP threads near their data (must be set before faiss loads)
+try:
+    import faiss
+except ImportError:
+    faiss = None
 import logging
 import numpy as np
-import os
-from collections import defaultdict
-from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter_ns
+
+QUERY_CHUNK = 4096 ### queries searched per tile (sized so db + tile stay resident in cache)
 
 def create_logger(logfile, loglevel):
     numeric_level = getattr(logging, loglevel.upper(), None)
@@ -23,29 +29,76 @@ def create_logger(logfile, loglevel):
 
 
 
+def search_chunked(index, vecs, k, sequential=False):
+    ### faiss releases the GIL during search: tiling the queries and searching the tiles
+    ### from a thread pool keeps all cores busy even when the query matrix is small.
+    ### GPU indexes are not thread-safe for concurrent searches: sequential keeps the
+    ### tiling (it batches the H2D transfers) but runs the tiles one after the other
+    if len(vecs) <= QUERY_CHUNK:
+        return index.search(vecs, k)
+    n_tiles = (len(vecs) + QUERY_CHUNK - 1) // QUERY_CHUNK
+    tiles = np.array_split(vecs, n_tiles)
+    if sequential:
+        results = [index.search(tile, k) for tile in tiles]
+    else:
+        with ThreadPoolExecutor() as executor:
+            results = list(executor.map(lambda tile: index.search(tile, k), tiles))
+    D = np.concatenate([D_i for D_i, _ in results])
+    I = np.concatenate([I_i for _, I_i in results])
+    return D, I
+
+
+def normalize_L2(vec):
+    ### vec must be a C-contiguous float32 matrix so faiss's SIMD kernel runs in place without an internal copy
+    if faiss is not None:
+        faiss.normalize_L2(vec)
+    else:
+        norms = np.sqrt(np.einsum('ij,ij->i', vec, vec))
+        norms[norms == 0.0] = 1.0
+        vec /= norms[:, None]
+
+
 class Infile:
 
-    def __init__(self, file, d=0, norm=True, max_vec=1000000):
+    def __init__(self, file, d=0, norm=True, max_vec=1000000, cache=False, file_str=None):
         logging.info('Reading {}'.format(file))
 
         self.file = file
         self.d = d     ### will contain length of vectors
-        self.vec = []  ### list with all vectors found in file
         self.max_vec = max_vec
-
-        if self.file.endswith('.gz'): 
-            f = gzip.open(self.file, 'rt')
+        self.txt = None ### optional sentences parallel to the vectors
+
+        ### cached matrices are saved already normalized (hence the name includes .norm)
+        fcache = self.file + ('.norm' if norm else '') + '.f32.npy'
+        if cache and os.path.exists(fcache) and os.path.getmtime(fcache) >= os.path.getmtime(self.file):
+            ### memory-map the cache: faiss copies on index.add so the mmap is fed directly (no text parse, no copy here)
+            self.vec = np.load(fcache, mmap_mode='r')
+            logging.info('\t\tLoaded cache {}'.format(fcache))
         else:
-            f = io.open(self.file, 'r', encoding='utf-8', newline='\n', errors='ignore')
-
-        for l in f:
-            l = l.rstrip().split(' ')
-            if self.d == 0:
-                self.d = len(l)
-            if len(l) != self.d:
-                logging.error('found a vector with {} cells instead of {} in line {} of file {}'.format(len(l),self.d,len(self.vec)+1,self.file))
+            if self.file.endswith('.gz'):
+                f = io.TextIOWrapper(gzip.open(self.file, 'rb'), encoding='utf-8', errors='ignore')
+            else:
+                f = io.open(self.file, 'r', encoding='utf-8', newline='\n', errors='ignore')
+
+            ### bulk-parse the whole file into a single contiguous float32 array
+            ### (avoids one python object per float and the list-of-lists round-trip)
+            try:
+                self.vec = np.loadtxt(f, dtype=np.float32, ndmin=2) ### matrix with all vectors found in file
+            except ValueError as e:
+                logging.error('failed to parse vectors from file {} ({})'.format(self.file,e))
                 sys.exit()
-            self.vec.append(l)
+            f.close()
+            if norm:
+                normalize_L2(self.vec) ### chunks below are views over this matrix
+            if cache:
+                np.save(fcache, self.vec)
+                logging.info('\t\tSaved cache {}'.format(fcache))
+
+        if self.d == 0:
+            self.d = self.vec.shape[1]
+        if self.vec.shape[1] != self.d:
+            logging.error('found vectors with {} cells instead of {} in file {}'.format(self.vec.shape[1],self.d,self.file))
+            sys.exit()
 
         if self.max_vec == 0:
             self.vecs = [self.vec]
@@ -54,64 +107,134 @@ class Infile:
         logging.info('\t\tRead {} vectors into {} chunks ({} cells)'.format(len(self.vec),len(self.vecs),self.d))
 
         for i in range(len(self.vecs)):
-            self.vecs[i] = np.array(self.vecs[i]).astype('float32')
+            ### slices of the parsed/mmapped matrix are already C-contiguous float32 so this is a no-copy check
+            self.vecs[i] = np.ascontiguousarray(self.vecs[i], dtype=np.float32)
             logging.info('\t\tBuilt float32 array for chunk {} with {} vectors'.format(i,len(self.vecs[i])))
-            if norm:
-                faiss.normalize_L2(self.vecs[i])
+
+        if file_str is not None:
+            if file_str.endswith('.gz'):
+                f = io.TextIOWrapper(gzip.open(file_str, 'rb'), encoding='utf-8', errors='ignore')
+            else:
+                f = io.open(file_str, 'r', encoding='utf-8', newline='\n', errors='ignore')
+            ### object array rather than list: txt[ids] gathers a whole result column in one fancy index
+            self.txt = np.asarray([l.rstrip('\n') for l in f], dtype=object)
+            f.close()
+            if len(self.txt) != len(self.vec):
+                logging.error('found {} sentences instead of {} in file {}'.format(len(self.txt),len(self.vec),file_str))
+                sys.exit()
+            logging.info('\t\tRead {} sentences from {}'.format(len(self.txt),file_str))
 
 
 class IndexFaiss:
 
-    def __init__(self, db):
+    def __init__(self, db, index_type=None, M=32, nlist=100, nprobe=8, quantize='none', gpu=False):
         self.db = db #infile containing the db
+        self.gpu = gpu
         self.indexs = []
+        res = faiss.StandardGpuResources() if gpu else None ### shared by all chunk indexes
         for i in range(len(self.db.vecs)): #we use n different indexs (one for each db chunk)
-            index = faiss.IndexFlatIP(self.db.d) #inner product (needs L2 normalization over db and query vectors)
+            index = self.build_index(self.db.vecs[i], index_type, M, nlist, nprobe, quantize)
+            if gpu: ### brute-force IP becomes a cuBLAS matmul on device (queries are already tiled by search_chunked)
+                index = faiss.index_cpu_to_gpu(res, 0, index)
             index.add(self.db.vecs[i]) #add all normalized vectors to the index
-            self.indexs.append(index) 
+            self.indexs.append(index)
+
+    def build_index(self, vecs, index_type, M, nlist, nprobe, quantize='none'):
+        if quantize == 'sq8': ### int8 scalar quantization: 4x less memory traffic than fp32
+            index = faiss.IndexScalarQuantizer(self.db.d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            index.train(vecs)
+            logging.info('\t\tBuilt sq8 index over {} vectors'.format(len(vecs)))
+            return index
+        elif quantize == 'pq': ### 4-bit product quantization with the fast-scan SIMD kernels
+            index = faiss.IndexPQFastScan(self.db.d, self.db.d//2, 4, faiss.METRIC_INNER_PRODUCT)
+            index.train(vecs)
+            logging.info('\t\tBuilt pq index over {} vectors'.format(len(vecs)))
+            return index
+        elif quantize != 'none':
+            logging.error('bad -quantize option {}'.format(quantize))
+            sys.exit()
+        if index_type is None: ### exhaustive search is only acceptable on small dbs
+            index_type = 'flat' if len(vecs) < 50000 else 'hnsw'
+        if index_type == 'flat':
+            index = faiss.IndexFlatIP(self.db.d) #inner product (needs L2 normalization over db and query vectors)
+        elif index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.db.d, M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 40
+        elif index_type == 'ivf':
+            quantizer = faiss.IndexFlatIP(self.db.d)
+            index = faiss.IndexIVFFlat(quantizer, self.db.d, nlist, faiss.METRIC_INNER_PRODUCT)
+            n_train = min(len(vecs), 100*nlist) ### training on a sample is enough for the coarse quantizer
+            train_vecs = vecs if n_train == len(vecs) else vecs[np.random.choice(len(vecs), n_train, replace=False)]
+            index.train(train_vecs)
+            index.nprobe = nprobe
+        else:
+            logging.error('bad -index_type option {}'.format(index_type))
+            sys.exit()
+        logging.info('\t\tBuilt {} index over {} vectors'.format(index_type,len(vecs)))
+        return index
 
-    def Query(self,query,k_best):
-        query_results = [] ### list of dicts (one dict for each line in this query file)
-        for _ in range(len(query.vec)):
-            query_results.append(defaultdict(float))
+    def Query(self,query,k_best,skip_same_id=False):
+        k_search = k_best + 2 + int(skip_same_id) ### computed once (never grown inside the loop): +2 spares for max_score filtering, +1 for the self match
+        all_scores = [] ### one [chunk_size,k_search] block per query chunk
+        all_ids = []
 
         for i_query in range(len(query.vecs)): #### chunk in query
+            Ds = []
+            Is = []
             for i_db in range(len(self.indexs)): #### chunk in db
 
                 logging.info('\t\tRunning search for [i_query={},i_db={}]'.format(i_query, i_db))
                 curr_db_index = self.indexs[i_db]
                 curr_query_vecs = query.vecs[i_query]
-                tstart = timer()
-                D, I = curr_db_index.search(curr_query_vecs, k_best+2) ### retrieve more than k in case the first are filtered out by max_score
+                tstart = perf_counter_ns()
+                D, I = search_chunked(curr_db_index, curr_query_vecs, k_search, sequential=self.gpu)
                 assert len(D) == len(I)               #I[i,j] contains the index in db of the j-th closest sentence to the i-th sentence in query
                 assert len(D) == len(curr_query_vecs) #D[i,j] contains the corresponding score
-                tend = timer()
-                sec_elapsed = (tend - tstart)
+                sec_elapsed = (perf_counter_ns() - tstart) / 1e9
                 vecs_per_sec = len(I) / sec_elapsed
                 logging.info('\t\tFound results for [i_query={},i_db={}] in {} sec [{:.2f} vecs/sec]'.format(i_query, i_db, sec_elapsed, vecs_per_sec))
 
-                for n in range(len(I)): #for each sentence in this query chunk, retrieve the k-closest
-                    n_query = n + (i_query * query.max_vec)
-                    for j in range(len(I[n])): ### for each result of this sentence
-                        n_db = I[n,j] + (i_db * self.db.max_vec)
-                        score = D[n,j]
-                        query_results[n_query][n_db] = score
-                        #print('inserted n_query={} len={}'.format(n_query,len(query_results[n_query])))
-                        if len(query_results[n_query]) >= k_best:
-                            break
+                ### dropped entries get -inf so the top-k partition below never keeps them
+                valid = I >= 0 ### hnsw/ivf indexes pad missing results with -1
+                if skip_same_id: ### drop the hit on the query's own db line (query file == db file)
+                    valid &= (I + (i_db * self.db.max_vec)) != (np.arange(len(I)) + (i_query * query.max_vec))[:, None]
+                Ds.append(np.where(valid, D, -np.inf))
+                Is.append(I + (i_db * self.db.max_vec)) ### global db line numbers
+
+            ### merge the db chunks: concatenate along the result axis and keep the k_search best per row
+            D = np.concatenate(Ds, axis=1)
+            I = np.concatenate(Is, axis=1)
+            rows = np.arange(len(D))[:, None]
+            if D.shape[1] > k_search:
+                top = np.argpartition(-D, k_search-1, axis=1)[:, :k_search]
+                D = D[rows, top]
+                I = I[rows, top]
+            order = np.argsort(-D, axis=1) ### descending score within each row
+            all_scores.append(D[rows, order])
+            all_ids.append(I[rows, order])
 
-        return query_results
+        return np.concatenate(all_scores), np.concatenate(all_ids)
 
 
 
 if __name__ == '__main__':
 
     fdb = None
+    fdb_str = None
     fqueries = []
     k = 1
     min_score = 0.0
     max_score = 9.9
     max_vec = 1000000
+    index_type = None
+    M = 32
+    nlist = 100
+    nprobe = 8
+    quantize = 'none'
+    gpu = False
+    threads = 0
+    skip_same_id = False
+    cache = False
     verbose = False
     log_file = None
     log_level = 'debug'
@@ -119,6 +242,7 @@ if __name__ == '__main__':
     name = sys.argv.pop(0)
     usage = '''usage: {} -db FILE [-query FILE]+ -tag STRING [-k INT] [-min_score FLOAT] [-max_score FLOAT] [-log_file FILE] [-log_level STRING]
     -db          FILE : db file with vectors
+    -db_str      FILE : db file with sentences parallel to -db (output text instead of line indexs)
     -query       FILE : query file/s with vectors
     -tag       STRING : use [query].[tag] to output matches (default stdout)
 
@@ -126,6 +250,16 @@ if __name__ == '__main__':
     -min_score  FLOAT : minimum distance to accept a match (default 0.0) 
     -max_score  FLOAT : maximum distance to accept a match (default 9.9) 
     -max_vec      INT : maximum vector length (default 1000000)
+    -skip_same_id     : do not match a query with its own db line (use when query file is the db file) (default False)
+    -cache            : save/reuse [file].norm.f32.npy binary caches next to vector files (default False)
+
+    -index_type STRING : faiss index to build: flat, hnsw, ivf (default flat if db < 50k vectors, hnsw otherwise)
+    -M            INT : hnsw links per node (default 32)
+    -nlist        INT : ivf inverted lists (default 100)
+    -nprobe       INT : ivf lists visited at search time (default 8)
+    -quantize  STRING : quantize db vectors: none, sq8, pq (default none)
+    -gpu              : run searches on GPU 0 (default False)
+    -threads      INT : faiss/OMP threads, 0 for the OMP default (default 0)
 
     -log_file    FILE : verbose output (default False)
     -log_level STRING : verbose output (default False)
@@ -154,12 +288,32 @@ All indexs start by 0
             verbose = True
         elif tok=="-db" and len(sys.argv):
             fdb = sys.argv.pop(0)
+        elif tok=="-db_str" and len(sys.argv):
+            fdb_str = sys.argv.pop(0)
         elif tok=="-query" and len(sys.argv):
             fqueries.append(sys.argv.pop(0))
         elif tok=="-k" and len(sys.argv):
             k = int(sys.argv.pop(0))
         elif tok=="-max_vec" and len(sys.argv):
             max_vec = int(sys.argv.pop(0))
+        elif tok=="-index_type" and len(sys.argv):
+            index_type = sys.argv.pop(0)
+        elif tok=="-M" and len(sys.argv):
+            M = int(sys.argv.pop(0))
+        elif tok=="-nlist" and len(sys.argv):
+            nlist = int(sys.argv.pop(0))
+        elif tok=="-nprobe" and len(sys.argv):
+            nprobe = int(sys.argv.pop(0))
+        elif tok=="-quantize" and len(sys.argv):
+            quantize = sys.argv.pop(0)
+        elif tok=="-gpu":
+            gpu = True
+        elif tok=="-threads" and len(sys.argv):
+            threads = int(sys.argv.pop(0))
+        elif tok=="-skip_same_id":
+            skip_same_id = True
+        elif tok=="-cache":
+            cache = True
         elif tok=="-min_score" and len(sys.argv):
             min_score = float(sys.argv.pop(0))
         elif tok=="-max_score" and len(sys.argv):
@@ -177,6 +331,10 @@ All indexs start by 0
 
     create_logger(log_file,log_level)
 
+    if threads > 0: ### the OMP default (#cores) over-commits when tiles are small
+        faiss.omp_set_num_threads(threads)
+        logging.info('faiss threads set to {}'.format(threads))
+
     if fdb is None:
         logging.error('error: missing -db option')
         sys.exit()
@@ -190,21 +348,21 @@ All indexs start by 0
         sys.exit()
 
     logging.info('*** Read DB ***')
-    indexfaiss = IndexFaiss(Infile(fdb, d=0, norm=True, max_vec=max_vec))
+    indexfaiss = IndexFaiss(Infile(fdb, d=0, norm=True, max_vec=max_vec, cache=cache, file_str=fdb_str), index_type=index_type, M=M, nlist=nlist, nprobe=nprobe, quantize=quantize, gpu=gpu)
 
     logging.info('*** Read Queries ***')
     for fquery in fqueries:
-        query = Infile(fquery, d=0, norm=True, max_vec=max_vec)
-        results = indexfaiss.Query(query,k)
+        query = Infile(fquery, d=0, norm=True, max_vec=max_vec, cache=cache)
+        scores, ids = indexfaiss.Query(query,k,skip_same_id=skip_same_id)
         with open(fquery+'.'+tag, "w") as fout:
-            for result in results: ### one line per query line
+            for i in range(len(scores)): ### one line per query line (rows come sorted by descending score)
                 res = []
-                for n_query, score in sorted(result.items(), key=lambda item: item[1], reverse=True):
-                    if score < min_score:
+                for score, n_db in zip(scores[i].tolist(), ids[i].tolist()):
+                    if score < min_score: ### also skips the -inf padding of dropped entries
                         break
                     if score > max_score:
                         continue
-                    res.append("{:.6f}\t{}".format(score,n_query))
+                    res.append("{:.6f}\t{}".format(score, indexfaiss.db.txt[n_db] if indexfaiss.db.txt is not None else n_db))
                     if len(res) >= k:
                         break
                 fout.write('\t'.join(res) + '\n')
@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 import logging
+import torch
 import yaml
 import sys
 import os
 import io
-import math
 import glob
 import gzip
 import random
 import itertools
 import pyonmttok
 import numpy as np
+from array import array
 from collections import defaultdict, Counter
 
 def open_file_read(file):
@@ -29,33 +30,47 @@ def open_file_read(file):
 class OpenNMTTokenizer():
 
     def __init__(self, fyaml):
-        opts = {}
+        ### tokenize/detokenize are bound once here so the per-line calls carry no None test
         if fyaml is None:
             self.tokenizer = None
-        else:
-            with open(fyaml) as yamlfile: 
-                opts = yaml.load(yamlfile, Loader=yaml.FullLoader)
+            self.tokenize = str.split
+            self.detokenize = lambda tokens: tokens
+            return
 
-            if 'mode' not in opts:
-                logging.error('error: missing mode in tokenizer')
-                sys.exit()
+        with open(fyaml) as yamlfile:
+            opts = yaml.load(yamlfile, Loader=yaml.FullLoader)
 
-            mode = opts["mode"]
-            del opts["mode"]
-            self.tokenizer = pyonmttok.Tokenizer(mode, **opts)
-            logging.info('built tokenizer mode={} {}'.format(mode,opts))
+        if 'mode' not in opts:
+            logging.error('error: missing mode in tokenizer')
+            sys.exit()
 
-    def tokenize(self, text):
-        if self.tokenizer is None:
-            tokens = text.split()
+        mode = opts["mode"]
+        del opts["mode"]
+        self.tokenizer = pyonmttok.Tokenizer(mode, **opts)
+        self.tokenize = lambda text, _t=self.tokenizer: _t.tokenize(text)[0]
+        self.detokenize = self.tokenizer.detokenize
+        logging.info('built tokenizer mode={} {}'.format(mode,opts))
+
+def build_alias(probs):
+    ### Walker alias tables for the given distribution: O(V) setup, two lookups
+    ### and one compare per draw afterwards (np.random.choice with p= is O(V) per call)
+    V = len(probs)
+    prob = np.ones(V, dtype=np.float64)
+    alias = np.arange(V, dtype=np.int64)
+    scaled = probs * V
+    small = [i for i in range(V) if scaled[i] < 1.0]
+    large = [i for i in range(V) if scaled[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
         else:
-            tokens, _ = self.tokenizer.tokenize(text)
-        return tokens
-
-    def detokenize(self, tokens):
-        if self.tokenizer is None:
-            return tokens
-        return self.tokenizer.detokenize(tokens)
+            large.append(l)
+    return prob, alias
 
 ####################################################################
 ### Vocab ##########################################################
@@ -144,101 +159,107 @@ class Dataset():
         self.vocab_size = len(vocab)
         self.idx_pad = vocab.idx_unk ### no need for additional token in vocab
         self.method = method
-        self.corpus = []
-        self.wrd2n = defaultdict(int)
-        ntokens = 0
-        nOOV = 0
+        self.pin_memory = args.cuda and torch.cuda.is_available() ### pinned batches allow async H2D copies
+        tokens = array('i')  ### flat int32 buffer with all token indexes (CSR layout, no boxed python ints kept around)
+        offsets = array('q') ### sentence i spans tokens[offsets[i]:offsets[i+1]]
+        offsets.append(0)
+        get_idx = vocab.tok_to_idx.get ### bound method: skips Vocab.__getitem__ type checks in the hot loop
+        idx_unk = vocab.idx_unk
+        tokenize = token.tokenize ### one attribute lookup instead of one per line
         for file in args.data:
             f, is_gzip = open_file_read(file)
             for l in f:
                 if is_gzip:
                     l = l.decode('utf8')
-                toks = token.tokenize(l.strip(' \n'))
-                idxs = []
-                for tok in toks:
-                    idx = vocab[tok]
-                    if idx == vocab.idx_unk:
-                        nOOV += 1
-                    idxs.append(idx)
-                    self.wrd2n[idx] += 1
-                self.corpus.append(idxs)
-                ntokens += len(idxs)
+                tokens.extend([get_idx(tok, idx_unk) for tok in tokenize(l.strip(' \n'))])
+                offsets.append(len(tokens))
             f.close()
+        ### a flat int32 array + offsets replaces the list of lists of python ints (~7x less memory, sequential access)
+        self.tokens = np.frombuffer(tokens, dtype=np.int32) ### zero-copy view over the accumulated buffer
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        ### count every word in one bincount pass (wrd2n[idx] is the frequency of idx in the corpus)
+        self.wrd2n = np.bincount(self.tokens, minlength=self.vocab_size)
+        ntokens = len(self.tokens)
+        nOOV = int(self.wrd2n[idx_unk])
         pOOV = 100.0 * nOOV / ntokens
-        logging.info('read {} sentences with {} tokens (%OOV={:.2f})'.format(len(self.corpus), ntokens, pOOV))
+        logging.info('read {} sentences with {} tokens (%OOV={:.2f})'.format(len(self.offsets)-1, ntokens, pOOV))
+        ### unigram^0.75 distribution used to draw negative samples (computed once, idx_unk excluded)
+        self.neg_p = self.wrd2n.astype(np.float64) ** 0.75
+        self.neg_p[self.idx_pad] = 0.0
+        self.neg_p /= self.neg_p.sum()
+        self.neg_prob, self.neg_alias = build_alias(self.neg_p) ### alias tables: O(1) per negative draw
         ### subsample
         if not skip_subsampling:
             ntokens = self.SubSample(ntokens)
             logging.info('subsampled to {} tokens'.format(ntokens))
 
 
-    def get_window_negs(self, toks, center, window, n_negs):
-        wrd = toks[center]
-        pos = []
-        neg = []
-        msk = [] #mask of positive words (to indicate true words 1.0 or padding 0.0)
-        for i in range(center-window,center+window+1):
-            if i < 0:
-                pos.append(self.idx_pad)
-                msk.append(False)
-            elif i >= len(toks):
-                pos.append(self.idx_pad)
-                msk.append(False)
-            elif i!=center:
-                pos.append(toks[i])
-                msk.append(True)
-        n = 0
-        while n < n_negs:
-            idx = random.randint(1, self.vocab_size-1) #do not consider idx=0 (unk)
-            if idx in pos or idx == wrd:
-                continue
-            neg.append(idx)
-            n += 1
-        return wrd, pos, neg, msk
-
-    def get_sentence_negs(self, sentence, center, n_negs):
-        wrd = sentence[center]
-        snt = list(sentence)
-        del snt[center]
-        msk = [True] * len(snt)
-        neg = []
-        n = 0
-        while n < n_negs:
-            idx = random.randint(1, self.vocab_size-1) #do not consider idx=0 (unk)
-            if idx in snt or idx == wrd:
-                continue
-            neg.append(idx)
-            n += 1
-        return wrd, snt, neg, msk
+    def pad_batch(self, batch_snt):
+        ### pad variable-length sentences once at emission (no rewriting of prior entries on every append)
+        max_len = max(len(snt) for snt in batch_snt)
+        snt = np.full((len(batch_snt), max_len), self.idx_pad, dtype=np.int64)
+        msk = np.zeros((len(batch_snt), max_len), dtype=bool)
+        for k in range(len(batch_snt)):
+            snt[k, :len(batch_snt[k])] = batch_snt[k]
+            msk[k, :len(batch_snt[k])] = True
+        return snt, msk
+
+    def to_tensor(self, a):
+        ### batches leave the Dataset as ready-made tensors: the model never rebuilds
+        ### them from python lists, and pinned memory makes the GPU copy asynchronous
+        t = torch.from_numpy(a)
+        if self.pin_memory:
+            t = t.pin_memory()
+        return t
+
+    def sentence(self, i):
+        ### view over the i-th sentence in the flat token array
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def sample_negs(self, size):
+        ### alias-method draw from the unigram^0.75 distribution (O(size), independent of vocab size)
+        i = np.random.randint(0, self.vocab_size, size=size)
+        r = np.random.random(size)
+        return np.where(r < self.neg_prob[i], i, self.neg_alias[i])
+
+    def get_windows(self, toks):
+        #builds the pos/msk rows of every center of a sentence in one shot
+        #(the window loop runs inside numpy instead of once per center in python)
+        #out-of-sentence positions hold idx_pad with mask False
+        toks = np.asarray(toks)
+        n = len(toks)
+        offs = np.concatenate((np.arange(-self.window, 0), np.arange(1, self.window+1))) #[2*window] center excluded
+        inds = np.arange(n)[:, None] + offs[None, :] #[n,2*window]
+        msk = (inds >= 0) & (inds < n)
+        pos = np.where(msk, toks[np.clip(inds, 0, n-1)], self.idx_pad)
+        return pos, msk
 
     def __iter__(self):
         ######################################################
         ### infer_sent #######################################
         ######################################################
         if self.method == 'infer_sent':
-            length = [len(self.corpus[i]) for i in range(len(self.corpus))]
-            indexs = np.argsort(np.array(length))
+            length = np.diff(self.offsets)
+            indexs = np.argsort(length)
             batch_snt = []
             batch_len = []
             batch_ind = []
             for index in indexs:
-                snt = self.corpus[index]
+                snt = self.sentence(index).tolist()
                 batch_snt.append(snt)
                 batch_len.append(len(snt))
                 batch_ind.append(index)
-                ### add padding
-                if len(batch_snt) > 1 and len(snt) > len(batch_snt[0]): 
-                    for k in range(len(batch_snt)-1):
-                        addn = len(batch_snt[-1]) - len(batch_snt[k])
-                        batch_snt[k] += [self.idx_pad]*addn
-                ### batch filled
+                ### batch filled (padding is applied once at emission)
                 if len(batch_snt) == self.batch_size:
-                    yield [batch_snt, batch_len, batch_ind]
+                    snt_mat, _ = self.pad_batch(batch_snt)
+                    ### lengths leave as an int32 tensor: no per-step list-to-tensor host loop
+                    yield [self.to_tensor(snt_mat), self.to_tensor(np.array(batch_len, dtype=np.int32)), batch_ind]
                     batch_snt = []
                     batch_len = []
                     batch_ind = []
             if len(batch_snt):
-                yield [batch_snt, batch_len, batch_ind]
+                snt_mat, _ = self.pad_batch(batch_snt)
+                yield [self.to_tensor(snt_mat), self.to_tensor(np.array(batch_len, dtype=np.int32)), batch_ind]
 
         ######################################################
         ### infer_word #######################################
@@ -247,9 +268,10 @@ class Dataset():
             batch_wrd = []
             batch_isnt = []
             batch_iwrd = []
-            for index in range(len(self.corpus)):
-                for iwrd in range(len(self.corpus[index])):
-                    batch_wrd.append(self.corpus[index][iwrd])
+            for index in range(len(self.offsets)-1):
+                snt = self.sentence(index).tolist()
+                for iwrd in range(len(snt)):
+                    batch_wrd.append(snt[iwrd])
                     batch_isnt.append(index)
                     batch_iwrd.append(iwrd)
                     ### batch filled
@@ -265,68 +287,56 @@ class Dataset():
         ### skipgram / cbow ##################################
         ######################################################
         #center word will be embedded by Input
-        #positive and negative words will be embedded by Output
+        #positive words will be embedded by Output
+        #negative words are drawn on-device by the model (Word2Vec.sample_negatives)
         elif self.method == 'skipgram' or self.method == 'cbow':
-            indexs = [i for i in range(len(self.corpus))]
-            random.shuffle(indexs) 
-            batch_wrd = []
-            batch_pos = []
-            batch_neg = []
-            batch_msk = []
+            indexs = [i for i in range(len(self.offsets)-1)]
+            random.shuffle(indexs)
+            ### preallocated batch buffers (fixed shape: 2*window positives)
+            batch_wrd = np.empty(self.batch_size, dtype=np.int64)
+            batch_pos = np.empty((self.batch_size, 2*self.window), dtype=np.int64)
+            batch_msk = np.empty((self.batch_size, 2*self.window), dtype=bool)
+            cursor = 0
             for index in indexs:
-                toks = self.corpus[index]
+                toks = self.sentence(index)
                 if len(toks) < 2: ### may be subsampled
                     continue
+                poss, msks = self.get_windows(toks)
                 for i in range(len(toks)):
-                    wrd, pos, neg, msk = self.get_window_negs(toks,i,self.window,self.n_negs)
-                    batch_wrd.append(wrd)
-                    batch_pos.append(pos)
-                    batch_neg.append(neg)
-                    batch_msk.append(msk)
-                    if len(batch_wrd) == self.batch_size:
-                        yield [batch_wrd, batch_pos, batch_neg, batch_msk]
-                        batch_wrd = []
-                        batch_pos = []
-                        batch_neg = []
-                        batch_msk = []
-            if len(batch_wrd):
-                yield [batch_wrd, batch_pos, batch_neg, batch_msk]
+                    batch_wrd[cursor] = toks[i]
+                    batch_pos[cursor] = poss[i]
+                    batch_msk[cursor] = msks[i]
+                    cursor += 1
+                    if cursor == self.batch_size:
+                        yield [self.to_tensor(batch_wrd.copy()), self.to_tensor(batch_pos.copy()), self.to_tensor(batch_msk.copy())]
+                        cursor = 0
+            if cursor:
+                yield [self.to_tensor(batch_wrd[:cursor].copy()), self.to_tensor(batch_pos[:cursor].copy()), self.to_tensor(batch_msk[:cursor].copy())]
 
         ######################################################
         ### sbow #############################################
         ######################################################
         elif self.method == 'sbow':
-            length = [len(self.corpus[i]) for i in range(len(self.corpus))]
-            indexs = np.argsort(np.array(length)) ### from smaller to largest sentences
+            length = np.diff(self.offsets)
+            indexs = np.argsort(length) ### from smaller to largest sentences
             batch_wrd = []
             batch_snt = []
-            batch_neg = []
-            batch_msk = []
             for index in indexs:
-                toks = self.corpus[index]
+                toks = self.sentence(index).tolist()
                 if len(toks) < 2: ### may be subsampled
                     continue
                 for i in range(len(toks)): #for each word in toks. Ex: 'a monster lives in my head'
-                    wrd, snt, neg, msk = self.get_sentence_negs(toks,i,self.n_negs)
-                    batch_wrd.append(wrd)
-                    batch_snt.append(snt)
-                    batch_neg.append(neg)
-                    batch_msk.append(msk)
-                    ### add padding
-                    if len(batch_snt) > 1 and len(snt) > len(batch_snt[0]): 
-                        for k in range(len(batch_snt)-1):
-                            addn = len(snt) - len(batch_snt[k])
-                            batch_snt[k] += [self.idx_pad]*addn
-                            batch_msk[k] += [False]*addn
-                    ### batch filled
+                    batch_wrd.append(toks[i])
+                    batch_snt.append(toks[:i] + toks[i+1:]) ### sentence without its center word
+                    ### batch filled (padding and masks are built once at emission)
                     if len(batch_wrd) == self.batch_size:
-                        yield [batch_wrd, batch_snt, batch_neg, batch_msk]
+                        snt_mat, msk_mat = self.pad_batch(batch_snt)
+                        yield [self.to_tensor(np.array(batch_wrd)), self.to_tensor(snt_mat), self.to_tensor(msk_mat)]
                         batch_wrd = []
                         batch_snt = []
-                        batch_neg = []
-                        batch_msk = []
             if len(batch_wrd):
-                yield [batch_wrd, batch_snt, batch_neg, batch_msk]
+                snt_mat, msk_mat = self.pad_batch(batch_snt)
+                yield [self.to_tensor(np.array(batch_wrd)), self.to_tensor(snt_mat), self.to_tensor(msk_mat)]
 
         ######################################################
         ### error ############################################
@@ -337,40 +347,20 @@ class Dataset():
 
 
     def SubSample(self, sum_counts):
-#        wrd2n = dict(Counter(list(itertools.chain.from_iterable(self.corpus))))
-        wrd2p_keep = {}
-        for wrd in self.wrd2n:
-            p_wrd = float(self.wrd2n[wrd]) / sum_counts ### proportion of the word
-            p_keep = 1e-3 / p_wrd * (1 + math.sqrt(p_wrd * 1e3)) ### probability to keep the word
-            wrd2p_keep[wrd] = p_keep
-
-        filtered_corpus = []
-        ntokens = 0
-        for toks in self.corpus:
-            filtered_corpus.append([])
-            for wrd in toks:
-                if random.random() < wrd2p_keep[wrd]:
-                    filtered_corpus[-1].append(wrd)
-                    ntokens += 1
-
-        self.corpus = filtered_corpus
-        return ntokens
+        p_wrd = self.wrd2n / float(sum_counts) ### proportion of each word
+        with np.errstate(divide='ignore'): ### unseen words get p_keep=inf but never occur in tokens
+            p_keep = 1e-3 / p_wrd * (1 + np.sqrt(p_wrd * 1e3)) ### probability to keep each word
+        ### one vectorized draw over the whole flat token array
+        mask = np.random.random(len(self.tokens)) < p_keep[self.tokens]
+        ### new sentence boundaries are the kept-token counts accumulated up to each old boundary
+        csum = np.concatenate(([0], np.cumsum(mask)))
+        self.offsets = csum[self.offsets].astype(np.int64)
+        self.tokens = self.tokens[mask]
+        return len(self.tokens)
 
     def NegativeSamples(self):
-#        wrd2n = dict(Counter(list(itertools.chain.from_iterable(self.corpus))))
-        normalizing_factor = sum([v**0.75 for v in self.wrd2n.values()])
-        sample_probability = {}
-        for wrd in self.wrd2n:
-            sample_probability[wrd] = self.wrd2n[wrd]**0.75 / normalizing_factor
-        words = np.array(list(sample_probability.keys()))
-        probs = np.array(list(sample_probability.values()))
         while True:
-            wrd_list = []
-            sampled_index = np.random.multinomial(self.n_negs, probs)
-            for index, count in enumerate(sampled_index):
-                for _ in range(count):
-                     wrd_list.append(words[index])
-            yield wrd_list
+            yield self.sample_negs(self.n_negs).tolist()
 
 
 
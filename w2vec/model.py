@@ -1,28 +1,23 @@
 # -*- coding: utf-8 -*-
 import torch
 import logging
-import yaml
 import sys
 import os
-import io
-import math
-import random
-import itertools
-import pyonmttok
 import glob
-import numpy as np
 import torch.nn as nn
-from collections import Counter
-from dataset import Dataset, Vocab, OpenNMTTokenizer, open_file_read
-
-min_sigm = 1e-06
-max_sigm = 1.0 - 1e-06
+import torch.nn.functional as F
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 def load_model_optim(pattern, EMBEDDING_SIZE, vocab, model, optimizer):
+    ### the optimizer is built by the caller: SparseAdam for the sparse embedding grads,
+    ### or AdamW(capturable=True, fused=True) on the dense -cuda_graph path
     files = sorted(glob.glob(pattern + '.model.?????????.pth')) 
     if len(files):
         file = files[-1] ### last is the newest
-        checkpoint = torch.load(file)
+        ### mmap streams the tensors from disk instead of unpickling a full copy into host
+        ### RAM first; weights_only skips arbitrary-pickle execution (the state is tensors only)
+        checkpoint = torch.load(file, map_location='cpu', mmap=True, weights_only=True)
         n_steps = checkpoint['n_steps']
         optimizer.load_state_dict(checkpoint['optimizer'])
         model.load_state_dict(checkpoint['model'])
@@ -32,74 +27,198 @@ def load_model_optim(pattern, EMBEDDING_SIZE, vocab, model, optimizer):
         logging.info('built model from scratch [{},{}]'.format(len(vocab),EMBEDDING_SIZE))
     return n_steps, model, optimizer
 
+### one background writer: the training loop only pays for the CPU snapshot,
+### the disk write happens off the step path (the interpreter waits for it at exit)
+_saver = ThreadPoolExecutor(max_workers=1)
+_saved_files = None ### filenames of written checkpoints, oldest first (directory scanned once)
+_last_save = None
+
+def _to_cpu(obj, memo=None):
+    ### CPU snapshot of a (nested) state_dict so the writer never reads tensors being updated.
+    ### memo keeps aliased tensors (e.g. the tied emb/iEmbBag weight) aliased in the snapshot
+    ### so torch.save serializes their storage once, as it does for the live state_dict
+    if memo is None:
+        memo = {}
+    if torch.is_tensor(obj):
+        key = (obj.data_ptr(), obj.dtype, tuple(obj.size()), tuple(obj.stride()))
+        if key not in memo:
+            t = obj.detach().to('cpu', non_blocking=True)
+            ### .to() on an already-CPU tensor returns a view over the live parameter:
+            ### clone it so optimizer.step() cannot mutate what the writer serializes
+            memo[key] = t if t.data_ptr() != obj.data_ptr() else t.clone()
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_to_cpu(v, memo) for v in obj]
+    return obj
+
+def _write_checkpoint(state, file, keep_last_n):
+    torch.save(state, file)
+    logging.info('saved checkpoint {}'.format(file))
+    if file not in _saved_files: ### the final save can repeat an n_steps already written
+        _saved_files.append(file)
+    while len(_saved_files) > keep_last_n:
+        f = _saved_files.popleft() ### first is the oldest
+        os.remove(f)
+        logging.debug('removed checkpoint {}'.format(f))
+
 def save_model_optim(pattern, model, optimizer, n_steps, keep_last_n):
+    global _saved_files, _last_save
+    if _saved_files is None:
+        _saved_files = deque(sorted(glob.glob(pattern + '.model.?????????.pth')))
     file = pattern + '.model.{:09d}.pth'.format(n_steps)
+    memo = {} ### shared so tensors aliased across model/optimizer stay deduplicated
     state = {
         'n_steps': n_steps,
-        'optimizer': optimizer.state_dict(),
-        'model': model.state_dict()
+        'optimizer': _to_cpu(optimizer.state_dict(), memo),
+        'model': _to_cpu(model.state_dict(), memo)
     }
-    torch.save(state, file)
-    logging.info('saved checkpoint {}'.format(file))
-    files = sorted(glob.glob(pattern + '.model.?????????.pth')) 
-    while len(files) > keep_last_n:
-        f = files.pop(0)
-        os.remove(f) ### first is the oldest
-        logging.debug('removed checkpoint {}'.format(f))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize() ### the non_blocking D2H copies must land before the writer reads them
+    if _last_save is not None:
+        _last_save.result() ### keep at most one write in flight (and surface its errors)
+    _last_save = _saver.submit(_write_checkpoint, state, file, keep_last_n)
+
+def wait_for_saves():
+    ### block until the in-flight checkpoint write completes, surfacing its errors
+    ### (call after the final save of a run, which no later save would otherwise check)
+    global _last_save
+    if _last_save is not None:
+        _last_save.result()
+        _last_save = None
 
-def sequence_mask(lengths):
-    lengths = np.array(lengths)
-    bs = len(lengths)
-    l = lengths.max()
-    msk = np.cumsum(np.ones([bs,l],dtype=int), axis=1).T #[l,bs] (transpose to allow combine with lenghts)
-    mask = (msk <= lengths) ### i use lenghts-1 because the last unpadded word is <eos> and i want it masked too
-    return mask.T #[bs,l]
+@torch.jit.script
+def _skipgram_loss(out, msk, n_pos: int):
+    ### scripted elementwise tail (target build + BCE + masked means) fuses into
+    ### one kernel instead of one launch and one full pass over [bs,np+nn] per op
+    target = torch.cat((torch.ones_like(out[:, :n_pos]), torch.zeros_like(out[:, n_pos:])), dim=1)
+    err = F.binary_cross_entropy_with_logits(out, target, reduction='none') #[bs,np+nn]
+    msk = msk.to(err.dtype)
+    ### positive words loss (avg errors of positive words)
+    loss = (torch.sum(err[:, :n_pos]*msk, dim=1) / torch.sum(msk, dim=1)).mean()
+    ### negative words loss (sum errors, do not average over negative words)
+    loss += torch.sum(err[:, n_pos:], dim=1).mean()
+    return loss
 
+@torch.jit.script
+def _center_negs_loss(out):
+    ### scripted elementwise tail shared by cbow/sbow: logit 0 is the center word,
+    ### the rest are negatives
+    target = torch.zeros_like(out)
+    target[:, 0] = 1.0
+    err = F.binary_cross_entropy_with_logits(out, target, reduction='none') #[bs,1+n]
+    ### center word loss (no need to average since there is only one)
+    ### negative words loss (sum of errors of all negative words, not averaged)
+    return err[:, 0].mean() + torch.sum(err[:, 1:], dim=1).mean()
 
 ####################################################################
 ### Word2Vec #######################################################
 ####################################################################
 class Word2Vec(nn.Module):
-    def __init__(self, vs, ds, pooling, pad_idx):
+    def __init__(self, vs, ds, pooling, pad_idx, debug=False, sparse=True, tie_weights=False):
         super(Word2Vec, self).__init__()
         self.vs = vs
         self.ds = ds
         self.pooling = pooling
         self.pad_idx = pad_idx
-        self.iEmb = nn.Embedding(self.vs, self.ds, padding_idx=self.pad_idx)#, max_norm=float(ds), norm_type=2)
-        self.oEmb = nn.Embedding(self.vs, self.ds, padding_idx=self.pad_idx)#, max_norm=float(ds), norm_type=2)
-        #nn.init.xavier_uniform_(self.iEmb.weight)
-        #nn.init.xavier_uniform_(self.oEmb.weight)
-        nn.init.uniform_(self.iEmb.weight, -0.1, 0.1)
-        nn.init.uniform_(self.oEmb.weight, -0.1, 0.1)
+        self.debug = debug ### enables the NaN/Inf checks (each one is a full reduction + host sync)
+        ### one table holds both embeddings: input rows at [0,vs), output rows at +o_off.
+        ### tie_weights shares the rows between the two layers (o_off=0), halving parameter
+        ### memory, optimizer state and lookup bandwidth
+        ### sparse=True: backward emits a COO grad over the looked-up rows only, instead of a
+        ### dense gradient tensor per step (pair with SparseAdam in the training loop)
+        self.o_off = 0 if tie_weights else self.vs
+        rows = self.vs + self.o_off
+        self.emb = nn.Embedding(rows, self.ds, padding_idx=self.pad_idx, sparse=sparse)#, max_norm=float(ds), norm_type=2)
+        #nn.init.xavier_uniform_(self.emb.weight)
+        nn.init.uniform_(self.emb.weight, -0.1, 0.1)
+        ### fused lookup+mean over the input half for avg pooling (same Parameter: no second table)
+        self.iEmbBag = nn.EmbeddingBag(rows, self.ds, mode='mean', padding_idx=self.pad_idx, sparse=sparse)
+        self.iEmbBag.weight = self.emb.weight
+        self._device = self.emb.weight.device ### cached; refreshed by _apply on .to()/.cuda() moves
+
+    def _apply(self, fn, recurse=True):
+        ### keep the cached device in sync when the module is moved, so the per-call
+        ### paths never re-read it from a parameter
+        module = super(Word2Vec, self)._apply(fn, recurse)
+        self._device = self.emb.weight.device
+        return module
+
+    def set_negative_sampler(self, prob, alias, n_negs):
+        ### alias tables of the unigram^0.75 distribution built by the Dataset, kept on the
+        ### model device (non-persistent: checkpoints stay loadable by the inference modes)
+        self.n_negs = n_negs
+        device = self._device
+        self.register_buffer('alias_q', torch.as_tensor(prob, dtype=torch.float32).to(device), persistent=False)
+        self.register_buffer('alias_j', torch.as_tensor(alias, dtype=torch.int64).to(device), persistent=False)
+
+    def sample_negatives(self, bs, n):
+        ### on-device alias draw: no per-step H2D copy of [bs,n] negatives, no python sampling loop
+        device = self.alias_q.device
+        k = torch.randint(self.vs, (bs*n,), device=device)
+        u = torch.rand(bs*n, device=device)
+        return torch.where(u < self.alias_q[k], k, self.alias_j[k]).view(bs, n)
+
+    def _snt_to_device(self, snt):
+        ### persistent device buffer for the padded sentence batch: grown on demand, then
+        ### every call reuses it with one async H2D copy instead of allocating a new tensor
+        bs, lw = snt.size(0), snt.size(1)
+        buf = getattr(self, '_snt_buf', None)
+        if buf is None or buf.size(0) < bs or buf.size(1) < lw:
+            if buf is not None:
+                bs, lw = max(bs, buf.size(0)), max(lw, buf.size(1))
+            self._snt_buf = buf = torch.empty(bs, lw, dtype=snt.dtype, device=self._device)
+        out = buf[:snt.size(0), :snt.size(1)]
+        out.copy_(snt, non_blocking=True)
+        return out
 
     def SentEmbed(self, snt, lens, layer):
         #snt [bs, lw] batch of sentences (list of list of words)
         #lns [bs] length of each sentence in batch
         #mask [bs, lw] contains 0.0 for masked words, 1.0 for unmaksed ones
 #        print('lens',lens)
-        snt = torch.as_tensor(snt) ### [bs,lw] batch with sentence words
+        snt = torch.as_tensor(snt) ### [bs,lw] batch with sentence words (already a pinned tensor when built by Dataset)
 #        print('snt.shape',snt.shape)
-        mask = torch.as_tensor(sequence_mask(lens))
-#        print('mask.shape',mask.shape)
-        if self.iEmb.weight.is_cuda:
-            snt = snt.cuda()
-            mask = mask.cuda()
+        if self._device.type == 'cuda':
+            snt = self._snt_to_device(snt)
+
+        if self.pooling == 'avg' and layer == 'iEmb':
+            ### embedding_bag pools during the lookup: the [bs,lw,ds] intermediate is never materialised
+            semb = self.iEmbBag(snt)
+            ### pad and unk share the same index, so the bag's mean divides by the count of
+            ### non-unk tokens only: rescale to the masked-average divisor (full sentence
+            ### length), keeping OOV-containing sentences on the training-time scale
+            lens = torch.as_tensor(lens)
+            if lens.device != snt.device:
+                lens = lens.to(snt.device, non_blocking=True)
+            n_real = (snt != self.pad_idx).sum(dim=1) #[bs] tokens the bag counted
+            semb = semb * (n_real / lens).unsqueeze(-1)
+            if __debug__ and self.debug and not torch.isfinite(semb).all():
+                logging.error('nan detected in snt_iemb')
+                sys.exit()
+            return semb
+
+        ### mask built directly on the target device by broadcasting: the lengths arrive as an
+        ### int32 tensor from the Dataset, so no python-side accumulation happens per step
+        lens = torch.as_tensor(lens)
+        if lens.device != snt.device:
+            lens = lens.to(snt.device, non_blocking=True)
+        mask = torch.arange(snt.size(1), device=snt.device)[None, :] < lens[:, None] #[bs,lw]
 
         if layer == 'iEmb':
-            semb = self.iEmb(snt)       
+            semb = self.emb(snt)
         elif layer == 'oEmb':
-            semb = self.oEmb(snt)       
+            semb = self.emb(snt + self.o_off if self.o_off else snt) ### output embeddings live at +o_off
         else:
             logging.error('bad layer value {}'.format(self.pooling))
             sys.exit()
 
         mask = mask.unsqueeze(-1) #[bs, lw, 1]
         if self.pooling == 'max':
-            #torch.max returns the maximum value of each row of the input tensor in the given dimension dim.
-            #since masked tokens after iemb*mask are 0.0 we need to make sure that 0.0 is not the max
-            #so all these masked tokens are added -999.9
-            semb, _ = torch.max(semb*mask + (1.0-mask)*-999.9, dim=1) #-999.9 should be -Inf but it produces a nan when multiplied by 0.0            
+            ### masked positions are -inf so they never win the max: one masked_fill pass
+            ### fused with the amax reduction (no magic -999.9, no extra fp32 temporaries)
+            semb = semb.masked_fill(~mask, float('-inf')).amax(dim=1)
         elif self.pooling == 'avg':
             semb = semb*mask
             semb = torch.sum(semb, dim=1)
@@ -110,75 +229,58 @@ class Word2Vec(nn.Module):
         else:
             logging.error('bad -pooling option {}'.format(self.pooling))
             sys.exit()
-        if torch.isnan(semb).any():
+        if __debug__ and self.debug and not torch.isfinite(semb).all():
             logging.error('nan detected in snt_iemb')
             sys.exit()
         return semb
 
 
     def Embed(self, wrd, layer):
-        wrd = torch.as_tensor(wrd) 
-        if self.iEmb.weight.is_cuda:
-            wrd = wrd.cuda()
-        if torch.isnan(wrd).any() or torch.isinf(wrd).any():
-            logging.error('NaN/Inf detected in input wrd {}'.format(wrd))
-            sys.exit()            
+        wrd = torch.as_tensor(wrd) ### already a pinned tensor when built by Dataset
+        if self._device.type == 'cuda':
+            wrd = wrd.to(self._device, non_blocking=True)
         if layer == 'iEmb':
-            emb = self.iEmb(wrd) #[bs,ds]
+            emb = self.emb(wrd) #[bs,ds]
         elif layer == 'oEmb':
-            emb = self.oEmb(wrd) #[bs,ds]
+            emb = self.emb(wrd + self.o_off if self.o_off else wrd) #[bs,ds] (output embeddings live at +o_off)
         else:
             logging.error('bad layer {}'.format(layer))
             sys.exit()
-        if torch.isnan(emb).any() or torch.isinf(emb).any():
+        if __debug__ and self.debug and not torch.isfinite(emb).all():
             logging.error('NaN/Inf detected in {} layer emb.shape={}\nwrds {}'.format(layer,emb.shape,wrd))
-            self.NaN(wrd,emb)
             sys.exit()
         return emb
 
     def forward_skipgram(self, batch):
-        #batch[0] : batch of center words (list)
-        #batch[1] : batch of positive words (list of list)
-        #batch[2] : batch of negative words (list of list)
-        #batch[3] : batch of masks for positive words (list of list)
-        msk = torch.as_tensor(batch[3]) #[bs,n] (positive words are 1.0 others are 0.0)
-        if self.iEmb.weight.is_cuda:
-            msk = msk.cuda()
+        #batch[0] : batch of center words (tensor)
+        #batch[1] : batch of positive words (tensor)
+        #batch[2] : batch of masks for positive words (tensor)
+        #negative words are sampled on-device below
+        msk = torch.as_tensor(batch[2]) #[bs,n] (positive words are 1.0 others are 0.0)
+        if self._device.type == 'cuda':
+            msk = msk.to(self._device, non_blocking=True)
 
         #Center word is embedded using iEmb
         wrd_emb = self.Embed(batch[0],'iEmb') #[bs,ds]
         #Positive/Negative words are embedded using oEmb
-        pos_emb = self.Embed(batch[1],'oEmb') #[bs,n,ds]  
-        neg_emb = self.Embed(batch[2],'oEmb').neg() #[bs,n,ds]  
-        ###
-        ### computing positive words loss
+        pos_emb = self.Embed(batch[1],'oEmb') #[bs,n,ds]
+        neg_emb = self.Embed(self.sample_negatives(pos_emb.size(0), self.n_negs),'oEmb') #[bs,n,ds] (the 0.0 target below plays the role of the old .neg())
+        n_pos = pos_emb.size(1)
         ###
-        #i use clamp to prevent NaN/Inf appear when computing the log of 1.0/0.0
-        err = torch.bmm(wrd_emb.unsqueeze(1), pos_emb.transpose(2,1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,n] = [bs,1,n] = > [bs,n]
-        err = torch.sum(err*msk, dim=1) / torch.sum(msk, dim=1) #[bs] (avg errors of positive words)
-        loss = err.mean()
+        ### one einsum against the concatenated positive/negative embeddings (one kernel, one pass over wrd_emb)
         ###
-        ### computing negative words loss
-        ###
-        err = torch.bmm(wrd_emb.unsqueeze(1), neg_emb.transpose(2,1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,n] = [bs,1,n] = > [bs,n]
-        err = torch.sum(err, dim=1) #[bs] (sum errors of negative words)
-        #do not average errors over negative words
-        loss += err.mean()
-
-        if torch.isnan(loss).any() or torch.isinf(loss).any():
-            logging.error('NaN/Inf detected in sgram_loss for batch {}'.format(batch))
-            sys.exit()        
-            
-        return loss
+        out = torch.einsum('bnd,bd->bn', torch.cat((pos_emb, neg_emb), dim=1), wrd_emb) #[bs,np+nn] logits (batched dot, no unsqueeze/squeeze views)
+        ### stable fused -log(sigmoid(+/-out)) tail, scripted into a single kernel
+        return _skipgram_loss(out, msk, n_pos)
 
     def forward_cbow(self, batch):
-        #batch[0] : batch of center words (list)
-        #batch[1] : batch of positive words (list of list)
-        #batch[2] : batch of negative words (list of list)
-        #batch[3] : batch of masks for positive words (list of list)
-        msk = torch.as_tensor(batch[3]) #[bs,n] (positive words are 1.0 others are 0.0)
-        if self.iEmb.weight.is_cuda:
-            msk = msk.cuda()
+        #batch[0] : batch of center words (tensor)
+        #batch[1] : batch of positive words (tensor)
+        #batch[2] : batch of masks for positive words (tensor)
+        #negative words are sampled on-device below
+        msk = torch.as_tensor(batch[2]) #[bs,n] (positive words are 1.0 others are 0.0)
+        if self._device.type == 'cuda':
+            msk = msk.to(self._device, non_blocking=True)
 
         #Positive words are embedded using the iEmb
         pos_emb = self.Embed(batch[1],'iEmb') #[bs,n,ds]
@@ -188,41 +290,30 @@ class Word2Vec(nn.Module):
         elif self.pooling == 'sum':
             pos_emb = (pos_emb*msk.unsqueeze(-1)).sum(1) #[bs,n,ds]x[bs,n,1]=>[bs,ds] 
         elif self.pooling == 'max':
-            pos_emb, _ = torch.max(pos_emb*msk + (1.0-msk)*-999.9, dim=1) #-999.9 should be -Inf but it produces a nan when multiplied by 0.0            
+            pos_emb = pos_emb.masked_fill(~msk.unsqueeze(-1), float('-inf')).amax(dim=1) ### -inf never wins the max
         else:
             logging.error('bad -pooling option {}'.format(self.pooling))
             sys.exit()
 
         #Center words are embedded using oEmb
         wrd_emb = self.Embed(batch[0],'oEmb') #[bs,ds]
-        #Negative words are embedded using oEmb
-        neg_emb = self.Embed(batch[2],'oEmb').neg() #[bs,n,ds]
-        ###
-        ### computing positive words loss
-        ###
-        #i use clamp to prevent NaN/Inf appear when computing the log of 1.0/0.0
-        err = torch.bmm(pos_emb.unsqueeze(1), wrd_emb.unsqueeze(-1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,1] = [bs,1] = > [bs]
-        loss = err.mean() # no need to average positive words errors since there is only one
+        #Negative words are sampled on-device and embedded using oEmb
+        neg_emb = self.Embed(self.sample_negatives(wrd_emb.size(0), self.n_negs),'oEmb') #[bs,n,ds] (the 0.0 target below plays the role of the old .neg())
         ###
-        ### computing negative words loss
+        ### one einsum of the pooled context against the concatenated center/negative embeddings
         ###
-        err = torch.bmm(pos_emb.unsqueeze(1), neg_emb.transpose(2,1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,n] = [bs,1,n] = > [bs,n]
-        err = torch.sum(err, dim=1) #[bs] (sum of errors of all negative words) (not averaged)
-        loss += err.mean()
-
-        if torch.isnan(loss).any() or torch.isinf(loss).any():
-            logging.error('NaN/Inf detected in cbow_loss for batch {}'.format(batch))
-            sys.exit()
-        return loss
+        out = torch.einsum('bnd,bd->bn', torch.cat((wrd_emb.unsqueeze(1), neg_emb), dim=1), pos_emb) #[bs,1+n] logits (batched dot, no unsqueeze/squeeze views)
+        ### scripted elementwise tail (single fused kernel)
+        return _center_negs_loss(out)
 
     def forward_sbow(self, batch):
-        #batch[0] : batch of center words (list)
-        #batch[1] : batch of sentences (list of list)
-        #batch[2] : batch of negative words (list of list)
-        #batch[3] : batch of sentence masks (list of list)
-        msk = torch.as_tensor(batch[3]) #[bs,n] (positive words are 1.0 others are 0.0)
-        if self.iEmb.weight.is_cuda:
-            msk = msk.cuda()
+        #batch[0] : batch of center words (tensor)
+        #batch[1] : batch of sentences (tensor)
+        #batch[2] : batch of sentence masks (tensor)
+        #negative words are sampled on-device below
+        msk = torch.as_tensor(batch[2]) #[bs,n] (positive words are 1.0 others are 0.0)
+        if self._device.type == 'cuda':
+            msk = msk.to(self._device, non_blocking=True)
 
         #Sentences are embedded using iEmb
         snt_emb = self.Embed(batch[1], 'iEmb') #[bs,n,ds]
@@ -232,33 +323,21 @@ class Word2Vec(nn.Module):
         elif self.pooling == 'sum':
             snt_emb = (snt_emb*msk.unsqueeze(-1)).sum(1) #[bs,n,ds]x[bs,n,1]=>[bs,ds] 
         elif self.pooling == 'max':
-            snt_emb, _ = torch.max(snt_emb*msk + (1.0-msk)*-999.9, dim=1) #-999.9 should be -Inf but it produces a nan when multiplied by 0.0            
+            snt_emb = snt_emb.masked_fill(~msk.unsqueeze(-1), float('-inf')).amax(dim=1) ### -inf never wins the max
         else:
             logging.error('bad -pooling option {}'.format(self.pooling))
             sys.exit()
 
         #Center words are embedded using oEmb
         wrd_emb  = self.Embed(batch[0],'oEmb') #[bs,ds]
-        #Negative words are embedded using oEmb
-        neg_emb = self.Embed(batch[2],'oEmb').neg() #[bs,n,ds]
+        #Negative words are sampled on-device and embedded using oEmb
+        neg_emb = self.Embed(self.sample_negatives(wrd_emb.size(0), self.n_negs),'oEmb') #[bs,n,ds] (the 0.0 target below plays the role of the old .neg())
 
         ###
-        ### computing sentence words loss
-        ###
-        #i use clamp to prevent NaN/Inf appear when computing the log of 1.0/0.0
-        err = torch.bmm(snt_emb.unsqueeze(1), wrd_emb.unsqueeze(-1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,1] = [bs,1] = > [bs]
-        loss = err.mean() # no need to average positive words errors since there is only one
-        ###
-        ### computing negative words loss
+        ### one einsum of the sentence embedding against the concatenated center/negative embeddings
         ###
-        err = torch.bmm(snt_emb.unsqueeze(1), neg_emb.transpose(2,1)).squeeze().sigmoid().clamp(min_sigm, max_sigm).log().neg() #[bs,1,ds] x [bs,ds,n] = [bs,1,n] = > [bs,n]
-        err = torch.sum(err, dim=1) #[bs] (sum of errors of all negative words) (not averaged)
-        loss += err.mean()
-
-        if torch.isnan(loss).any() or torch.isinf(loss).any():
-            logging.error('NaN/Inf detected in sbow_loss for batch {}'.format(batch))
-            sys.exit()
-
-        return loss
+        out = torch.einsum('bnd,bd->bn', torch.cat((wrd_emb.unsqueeze(1), neg_emb), dim=1), snt_emb) #[bs,1+n] logits (batched dot, no unsqueeze/squeeze views)
+        ### scripted elementwise tail (single fused kernel)
+        return _center_negs_loss(out)
 
 
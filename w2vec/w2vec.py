@@ -14,7 +14,7 @@ import numpy as np
 import torch.nn as nn
 from collections import Counter
 from dataset import Dataset, Vocab, OpenNMTTokenizer, open_file_read
-from model import Word2Vec, load_model_optim, save_model_optim
+from model import Word2Vec, load_model_optim, save_model_optim, wait_for_saves
 
 
 def create_logger(logfile, loglevel):
@@ -32,6 +32,7 @@ def create_logger(logfile, loglevel):
 def read_params(args):
     embedding_size = None
     pooling = None
+    tie_weights = False ### absent in .param files written before the option existed
     if not os.path.exists(args.name + '.param'):
         logging.error('missing {}.param file'.format(args.name))
         sys.exit()
@@ -45,18 +46,22 @@ def read_params(args):
             if desc == 'pooling':
                 pooling = val
                 logging.info('updated pooling {}'.format(pooling))
+            if desc == 'tie_weights':
+                tie_weights = val == 'True'
+                logging.info('updated tie_weights {}'.format(tie_weights))
     if embedding_size is None:
         logging.error('missing embedding_size in {}.param'.format(args.name))
         sys.exit()
     if pooling is None:
         logging.error('missing pooling in {}.param'.format(args.name))
         sys.exit()
-    return embedding_size, pooling
+    return embedding_size, pooling, tie_weights
 
 def write_params(args):
     with open(args.name + '.param', 'w') as f:
         f.write('embedding_size {}\n'.format(args.embedding_size))
         f.write('pooling {}\n'.format(args.pooling))
+        f.write('tie_weights {}\n'.format(args.tie_weights))
 
 def do_preprocess(args):
 
@@ -91,18 +96,65 @@ def do_train(args):
     vocab = Vocab()
     vocab.read(args.name + '.vocab')
     if os.path.exists(args.name + '.param'):
-        args.embedding_size, args.pooling = read_params(args)
+        args.embedding_size, args.pooling, args.tie_weights = read_params(args)
     else:
-        write_params(args)        
+        write_params(args)
 
-    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk)
+    ### sparse grads cannot be captured in a CUDA graph: -cuda_graph keeps dense grads + capturable AdamW
+    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk, sparse=not args.cuda_graph, tie_weights=args.tie_weights)
     if args.cuda:
         model.cuda()
 #    optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate, betas=(args.beta1,args.beta2), eps=args.eps)
 #    optimizer = torch.optim.SGD(model.parameters(), lr=0.05)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate, betas=(args.beta1, args.beta2), eps=args.eps, weight_decay=0.01, amsgrad=False)
+    if args.cuda_graph:
+        ### capturable makes optimizer.step() replayable inside a CUDA graph;
+        ### fused runs the whole dense update as one CUDA kernel over the parameter list
+        optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate, betas=(args.beta1, args.beta2), eps=args.eps, weight_decay=0.01, amsgrad=False, capturable=True, fused=True)
+    else:
+        ### embedding backward emits COO grads: SparseAdam updates only the touched rows
+        optimizer = torch.optim.SparseAdam(model.parameters(), lr=args.learning_rate, betas=(args.beta1, args.beta2), eps=args.eps)
     n_steps, model, optimizer = load_model_optim(args.name, args.embedding_size, vocab, model, optimizer)
     dataset = Dataset(args, token, vocab, args.method)
+    ### negatives are drawn on-device from the corpus unigram^0.75 alias tables
+    model.set_negative_sampler(dataset.neg_prob, dataset.neg_alias, args.n_negs)
+
+    if args.bf16 and not args.cuda:
+        logging.error('-bf16 needs -cuda')
+        sys.exit()
+    ### BF16 autocast halves activation bytes in the lookups/bmms; weights and
+    ### optimizer state stay FP32 (BCE runs in logit space so no loss scaling needed)
+    autocast = lambda: torch.autocast('cuda', dtype=torch.bfloat16, enabled=args.bf16)
+
+    graph = None
+    if args.cuda_graph:
+        if not args.cuda or args.method not in ('skipgram', 'cbow'):
+            logging.error('-cuda_graph needs -cuda and -method skipgram or cbow (fixed-shape batches)')
+            sys.exit()
+        ### skipgram/cbow batches have fixed shapes: capture forward+backward+step once
+        ### and replay it, removing every per-step kernel launch but the input copies
+        forward = model.forward_skipgram if args.method == 'skipgram' else model.forward_cbow
+        static = [torch.zeros(args.batch_size, dtype=torch.int64, device='cuda'),
+                  torch.zeros((args.batch_size, 2*args.window), dtype=torch.int64, device='cuda'),
+                  torch.ones((args.batch_size, 2*args.window), dtype=torch.bool, device='cuda')]
+        ### warmup on a side stream so cuDNN/cuBLAS setup is not captured
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(3):
+                optimizer.zero_grad(set_to_none=True)
+                with autocast():
+                    loss = forward(static)
+                loss.backward()
+                optimizer.step()
+        torch.cuda.current_stream().wait_stream(s)
+        graph = torch.cuda.CUDAGraph()
+        optimizer.zero_grad(set_to_none=True) ### grads are (re)allocated from the graph pool during capture
+        with torch.cuda.graph(graph):
+            with autocast():
+                static_loss = forward(static)
+            static_loss.backward()
+            optimizer.step()
+        logging.info('captured training step as a CUDA graph (batch_size={})'.format(args.batch_size))
 
     n_epochs = 0
     losses = []
@@ -110,15 +162,23 @@ def do_train(args):
         n_epochs += 1
         for batch in dataset:
             model.train()
-            if args.method == 'skipgram':
-                loss = model.forward_skipgram(batch)
-            elif args.method == 'cbow':
-                loss = model.forward_cbow(batch)
-            elif args.method == 'sbow':
-                loss = model.forward_sbow(batch)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            if graph is not None and batch[0].size(0) == args.batch_size:
+                ### full-size batch: refresh the static inputs and replay the captured step
+                for st, b in zip(static, batch):
+                    st.copy_(b, non_blocking=True)
+                graph.replay()
+                loss = static_loss
+            else: ### eager path (no capture, or last short batch of the epoch)
+                with autocast():
+                    if args.method == 'skipgram':
+                        loss = model.forward_skipgram(batch)
+                    elif args.method == 'cbow':
+                        loss = model.forward_cbow(batch)
+                    elif args.method == 'sbow':
+                        loss = model.forward_sbow(batch)
+                optimizer.zero_grad(set_to_none=True) ### drop grads instead of memsetting them
+                loss.backward()
+                optimizer.step()
             n_steps += 1
             losses.append(loss.data.cpu().detach().numpy())
             if n_steps % args.report_every_n_steps == 0:
@@ -131,6 +191,7 @@ def do_train(args):
             logging.info('Stop (max epochs reached)')
             break
     save_model_optim(args.name, model, optimizer, n_steps, args.keep_last_n)
+    wait_for_saves() ### the final write has no later save to surface its errors
 
 def do_infer_word(args):
     if not os.path.exists(args.name + '.token'):
@@ -146,9 +207,9 @@ def do_infer_word(args):
     token = OpenNMTTokenizer(args.name + '.token')
     vocab = Vocab()
     vocab.read(args.name + '.vocab')
-    args.embedding_size, args.pooling = read_params(args)
-    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk)
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate, betas=(args.beta1,args.beta2), eps=args.eps)
+    args.embedding_size, args.pooling, args.tie_weights = read_params(args)
+    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk, tie_weights=args.tie_weights)
+    optimizer = torch.optim.SparseAdam(model.parameters(), lr=args.learning_rate, betas=(args.beta1,args.beta2), eps=args.eps)
     n_steps, model, optimizer = load_model_optim(args.name, args.embedding_size, vocab, model, optimizer)
     if args.cuda:
         model.cuda()
@@ -207,9 +268,9 @@ def do_infer_sent(args):
     token = OpenNMTTokenizer(args.name + '.token')
     vocab = Vocab()
     vocab.read(args.name + '.vocab')
-    args.embedding_size, args.pooling = read_params(args)
-    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk)
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate, betas=(args.beta1,args.beta2), eps=args.eps)
+    args.embedding_size, args.pooling, args.tie_weights = read_params(args)
+    model = Word2Vec(len(vocab), args.embedding_size, args.pooling, vocab.idx_unk, tie_weights=args.tie_weights)
+    optimizer = torch.optim.SparseAdam(model.parameters(), lr=args.learning_rate, betas=(args.beta1,args.beta2), eps=args.eps)
     n_steps, model, optimizer = load_model_optim(args.name, args.embedding_size, vocab, model, optimizer)
     if args.cuda:
         model.cuda()
@@ -252,7 +313,10 @@ class Args():
         self.eps = 1e-08
         self.beta1 = 0.9
         self.beta2 = 0.999
-        self.skip_subsampling = False    
+        self.skip_subsampling = False
+        self.tie_weights = False
+        self.cuda_graph = False
+        self.bf16 = False
         self.keep_last_n = 5
         self.save_every_n_steps = 5000
         self.report_every_n_steps = 500
@@ -281,6 +345,7 @@ class Args():
    -window          INT : window size                               (5)
    -n_negs          INT : number of negative samples generated      (10)
    -skip_subsampling    : do not subsample corpora                  (False)
+   -tie_weights         : share input/output embedding table        (False)
    -batch_size      INT : batch size used                           (1024)
    -max_epochs      INT : stop learning after this number of epochs (1)
    -learning_rate FLOAT : learning rate for Adam optimizer          (0.001)
@@ -290,6 +355,8 @@ class Args():
    -keep_last       INT : keep last n checkpoints                   (5)
    -save_every      INT : save checkpoint every n learning steps    (5000)
    -report_every    INT : print report every n learning steps       (500)
+   -cuda_graph          : replay train step as a CUDA graph         (False)
+   -bf16                : run forward in bfloat16 autocast          (False)
  -------- When inference -----------------------------------------------------
    -k               INT : find k closest words to each word in file (5)
    -sim          STRING : cos, pairwise                             (cos)
@@ -326,6 +393,9 @@ class Args():
             elif (tok=="-beta1" and len(argv)): self.beta1 = float(argv.pop(0))
             elif (tok=="-beta2" and len(argv)): self.beta2 = float(argv.pop(0))
             elif (tok=="-skip_subsampling"): self.skip_subsampling = True
+            elif (tok=="-tie_weights"): self.tie_weights = True
+            elif (tok=="-cuda_graph"): self.cuda_graph = True
+            elif (tok=="-bf16"): self.bf16 = True
             elif (tok=="-keep_last" and len(argv)): self.keep_last_n = int(argv.pop(0))
             elif (tok=="-save_every" and len(argv)): self.save_every_n_steps = int(argv.pop(0))
             elif (tok=="-report_every" and len(argv)): self.report_every_n_steps = int(argv.pop(0))
@@ -360,6 +430,7 @@ class Args():
 
         if self.seed > 0:
             random.seed(self.seed)
+            np.random.seed(self.seed) ### subsampling and the alias draws use the numpy RNG
             torch.manual_seed(self.seed)
             if torch.cuda.is_available():
                 torch.cuda.manual_seed_all(self.seed)